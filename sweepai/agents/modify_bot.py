@@ -149,6 +149,27 @@ Maximize information density and conciseness but be detailed.
 
 UPDATE_SNIPPETS_MAX_TOKENS = 1450
 
+analysis_and_identification_pattern = re.compile(
+    r"<analysis_and_identification.*?>\n(?P<code>.*)\n</analysis_and_identification>",
+    re.DOTALL,
+)
+extraction_term_pattern = re.compile(
+    r"<extraction_terms.*?>\n(?P<extraction_term>.*?)\n</extraction_terms>",
+    re.DOTALL,
+)
+snippets_query_pattern = re.compile(
+    r"<section_to_modify.*?(reason=\"(?P<reason>.*?)\")?>\n(?P<section>.*?)\n</section_to_modify>",
+    re.DOTALL,
+)
+updated_pattern = re.compile(
+    r"<<<<<<<\s+(APPEND|REPLACE)\s+\(index=(?P<index>\d+)\)(.*?)\n(?P<original_code>.*?)=======(?P<updated_code>.*?)>>>>>>>",
+    re.DOTALL,
+)
+append_pattern = re.compile(
+    r"<<<<<<<\s+APPEND\s+\(index=(?P<index>\d+)\)(.*?)\n(?P<updated_code>.*?)>>>>>>>",
+    re.DOTALL,
+)
+
 
 def get_last_import_line(code: str, max_: int = 150) -> int:
     lines = code.split("\n")
@@ -171,6 +192,20 @@ class MatchToModify:
     reason: str
 
 
+def get_line_offsets(contents: str) -> list[int]:
+    # offsets[i] is where line i of contents.split("\n") starts, with one past the end appended
+    return [0, *(match.end() for match in re.finditer("\n", contents)), len(contents) + 1]
+
+
+def slice_lines(contents: str, line_offsets: list[int], start: int, end: int) -> str:
+    # same as "\n".join(contents.split("\n")[start:end]) without building the list
+    num_lines = len(line_offsets) - 1
+    start, end = min(start, num_lines), min(end, num_lines)
+    if start >= end:
+        return ""
+    return contents[line_offsets[start] : line_offsets[end] - 1]
+
+
 def strip_backticks(s: str) -> str:
     s = s.strip()
     if s.startswith("```"):
@@ -183,6 +218,13 @@ def strip_backticks(s: str) -> str:
     return s
 
 
+def format_snippets(snippets: list[tuple[str, str, tuple[int, int]]]) -> str:
+    return "\n\n".join(
+        f'<snippet index="{i}" reason="{reason}">\n{snippet}\n</snippet>'
+        for i, (reason, snippet, _span) in enumerate(snippets)
+    )
+
+
 def convert_comment_to_deletion(original, updated):
     # check both are single lines
     if "\n" in original or "\n" in updated:
@@ -321,9 +363,9 @@ class ModifyBot:
             fetch_snippets_prompt_with_diff if diffs_message else fetch_snippets_prompt
         )
         original_snippets = chunk_code(file_contents, file_path, 700, 200)
-        file_contents_lines = file_contents.split("\n")
+        line_offsets = get_line_offsets(file_contents)
         chunks = [
-            "\n".join(file_contents_lines[snippet.start : snippet.end])
+            slice_lines(file_contents, line_offsets, snippet.start, snippet.end)
             for snippet in original_snippets
         ]
         code_sections = []
@@ -334,7 +376,7 @@ class ModifyBot:
         fetch_snippets_response = self.fetch_snippets_bot.chat(
             fetch_prompt.format(
                 code="\n".join(code_sections),
-                changes_made=self.get_diffs_message(file_contents),
+                changes_made=diffs_message,
                 file_path=file_path,
                 request=file_change_request.instructions,
                 chunking_message=(
@@ -342,9 +384,8 @@ class ModifyBot:
                 ),
             )
         )
-        analysis_and_identification_pattern = r"<analysis_and_identification.*?>\n(?P<code>.*)\n</analysis_and_identification>"
-        analysis_and_identification_match = re.search(
-            analysis_and_identification_pattern, fetch_snippets_response, re.DOTALL
+        analysis_and_identification_match = analysis_and_identification_pattern.search(
+            fetch_snippets_response
         )
         analysis_and_identifications_str = (
             analysis_and_identification_match.group("code").strip()
@@ -353,21 +394,13 @@ class ModifyBot:
         )
 
         extraction_terms = []
-        extraction_term_pattern = (
-            r"<extraction_terms.*?>\n(?P<extraction_term>.*?)\n</extraction_terms>"
-        )
-        for extraction_term in re.findall(
-            extraction_term_pattern, fetch_snippets_response, re.DOTALL
-        ):
+        for extraction_term in extraction_term_pattern.findall(fetch_snippets_response):
             for term in extraction_term.split("\n"):
                 term = term.strip()
                 if term:
                     extraction_terms.append(term)
         snippet_queries = []
-        snippets_query_pattern = r"<section_to_modify.*?(reason=\"(?P<reason>.*?)\")?>\n(?P<section>.*?)\n</section_to_modify>"
-        for match_ in re.finditer(
-            snippets_query_pattern, fetch_snippets_response, re.DOTALL
-        ):
+        for match_ in snippets_query_pattern.finditer(fetch_snippets_response):
             section = match_.group("section").strip()
             # processing logic to sanitize input, sometimes adds "SECTION_ID: A"
             if " " in section:
@@ -398,6 +431,10 @@ class ModifyBot:
         analysis_and_identification: str = "",
     ):
         is_python_file = file_path.strip().endswith(".py")
+        line_offsets = get_line_offsets(file_contents)
+        # splitlines() doesn't count an empty line after a trailing newline
+        num_lines = len(line_offsets) - 1 - (not file_contents or file_contents.endswith("\n"))
+        diffs_message = self.get_diffs_message(file_contents)
 
         best_matches = []
         snippet_queries = sorted(snippet_queries, key=lambda x: x.snippet.start)
@@ -421,12 +458,12 @@ class ModifyBot:
                 start=max(snippet_to_modify.snippet.start - left_expand_size, 0),
                 end=min(
                     snippet_to_modify.snippet.end + 1 + right_expand_size,
-                    len(file_contents.splitlines()),
+                    num_lines,
                 ),
                 reason=snippet_to_modify.reason,
             )
             best_matches.append(match_to_modify)
-        best_matches.sort(key=lambda x: x.start + x.end * 0.00001)
+        best_matches.sort(key=lambda x: (x.start, x.end))
 
         def fuse_matches(a: MatchToModify, b: MatchToModify) -> MatchToModify:
             reason = (
@@ -447,9 +484,10 @@ class ModifyBot:
         deduped_matches = best_matches
 
         selected_snippets: list[tuple[str, str, tuple[int, int]]] = []
-        file_contents_lines = file_contents.split("\n")
         for match_ in deduped_matches:
-            current_contents = "\n".join(file_contents_lines[match_.start : match_.end])
+            current_contents = slice_lines(
+                file_contents, line_offsets, match_.start, match_.end
+            )
             selected_snippets.append(
                 (match_.reason, current_contents, (match_.start, match_.end))
             )
@@ -462,16 +500,9 @@ class ModifyBot:
 
         if len(selected_snippets) > 1:
             indices_to_keep = self.prune_modify_snippets_bot.prune_modify_snippets(
-                snippets="\n\n".join(
-                    [
-                        f'<snippet index="{i}" reason="{reason}">\n{snippet}\n</snippet>'
-                        for i, (reason, snippet, (_start, _end)) in enumerate(
-                            selected_snippets
-                        )
-                    ]
-                ),
+                snippets=format_snippets(selected_snippets),
                 file_path=file_path,
-                changes_made=self.get_diffs_message(file_contents),
+                changes_made=diffs_message,
                 old_code=update_snippets_code,
                 request=file_change_request.instructions,
             )
@@ -486,6 +517,7 @@ class ModifyBot:
             if idx in indices_to_keep:
                 pruned_snippets.append(snippet)
         selected_snippets = pruned_snippets
+        snippets_str = format_snippets(selected_snippets)
 
         if is_python_file:
             self.update_snippets_bot.messages[
@@ -508,46 +540,23 @@ class ModifyBot:
                     update_prompt.format(
                         code=update_snippets_code,
                         file_path=file_path,
-                        snippets="\n\n".join(
-                            [
-                                f'<snippet index="{i}" reason="{reason}">\n{snippet}\n</snippet>'
-                                for i, (reason, snippet, _span) in enumerate(
-                                    selected_snippets
-                                )
-                            ]
-                        ),
+                        snippets=snippets_str,
                         request=file_change_request.instructions,
                         n=len(selected_snippets),
-                        changes_made=self.get_diffs_message(file_contents),
+                        changes_made=diffs_message,
                     ),
                     max_tokens=UPDATE_SNIPPETS_MAX_TOKENS,
                 )
             updated_snippets: dict[int, str] = {}
             # try matching append first, and if any of these match remove them from the response
-            updated_pattern = r"<<<<<<<\s+(APPEND|REPLACE)\s+\(index=(?P<index>\d+)\)(.*?)\n(?P<original_code>.*?)=======(?P<updated_code>.*?)>>>>>>>"
-            append_pattern = r"<<<<<<<\s+APPEND\s+\(index=(?P<index>\d+)\)(.*?)\n(?P<updated_code>.*?)>>>>>>>"
-
+            append_matches = list(append_pattern.finditer(update_snippets_response))
             if (
-                len(
-                    list(
-                        re.finditer(
-                            updated_pattern, update_snippets_response, re.DOTALL
-                        )
-                    )
-                )
-                == 0
-                and len(
-                    list(
-                        re.finditer(append_pattern, update_snippets_response, re.DOTALL)
-                    )
-                )
-                == 0
+                not append_matches
+                and updated_pattern.search(update_snippets_response) is None
             ):
                 raise UnneededEditError("No snippets edited")
 
-            for match_ in re.finditer(
-                append_pattern, update_snippets_response, re.DOTALL
-            ):
+            for match_ in append_matches:
                 index = int(match_.group("index"))
                 updated_code = match_.group("updated_code").strip("\n")
 
@@ -571,14 +580,10 @@ class ModifyBot:
                 )
 
             # delete all of the append matches to avoid re-matching them with our updated_pattern
-            update_snippets_response = re.sub(
-                append_pattern, "", update_snippets_response, flags=re.DOTALL
-            )
+            update_snippets_response = append_pattern.sub("", update_snippets_response)
 
             problematic_matches = []
-            for match_ in re.finditer(
-                updated_pattern, update_snippets_response, re.DOTALL
-            ):
+            for match_ in updated_pattern.finditer(update_snippets_response):
                 index = int(match_.group("index"))
                 original_code = match_.group("original_code").strip("\n")
                 updated_code = match_.group("updated_code").strip("\n")
@@ -617,7 +622,7 @@ class ModifyBot:
                     selected_snippets[index][2],
                 )
 
-            result = file_contents
+            lines = file_contents.splitlines()
             new_code = []
             for idx, (_reason, _search, (start, end)) in reversed(
                 list(enumerate(selected_snippets))
@@ -625,10 +630,10 @@ class ModifyBot:
                 if idx not in updated_snippets:
                     continue
                 replace = updated_snippets[idx]
-                lines = result.splitlines()
                 lines[start:end] = replace.splitlines()
-                result = "\n".join(lines)  # sliding window coalesce
                 new_code.append(replace)
+            # sliding window coalesce
+            result = "\n".join(lines) if new_code else file_contents
 
             ending_newlines = len(file_contents) - len(file_contents.rstrip("\n"))
             result = result.rstrip("\n") + "\n" * ending_newlines
@@ -0,0 +1,35 @@
+import pytest
+
+from sweepai.agents.modify_bot import get_line_offsets, slice_lines
+
+contents_cases = ["", "a", "a\n", "\n\n", "def f():\n    return 1\n\nx = f()", "a\r\nb\r\n"]
+
+
+@pytest.mark.parametrize("contents", contents_cases)
+def test_slice_lines_matches_split_join(contents):
+    line_offsets = get_line_offsets(contents)
+    num_lines = len(contents.split("\n"))
+    for start in range(num_lines + 2):
+        for end in range(num_lines + 2):
+            assert slice_lines(contents, line_offsets, start, end) == "\n".join(
+                contents.split("\n")[start:end]
+            )
+
+
+def test_slice_lines_clamps_end():
+    contents = "a\nb\nc"
+    line_offsets = get_line_offsets(contents)
+    assert slice_lines(contents, line_offsets, 1, 100) == "b\nc"
+    assert slice_lines(contents, line_offsets, 100, 200) == ""
+
+
+def test_slice_lines_empty_range():
+    contents = "a\nb\nc"
+    line_offsets = get_line_offsets(contents)
+    assert slice_lines(contents, line_offsets, 2, 2) == ""
+    assert slice_lines(contents, line_offsets, 2, 1) == ""
+
+
+def test_get_line_offsets():
+    assert get_line_offsets("ab\ncd\n") == [0, 3, 6, 7]
+    assert get_line_offsets("") == [0, 1]
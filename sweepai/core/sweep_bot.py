@@ -194,10 +194,13 @@ class CodeGenBot(ChatGPT):
                 file_change_request = FileChangeRequest.from_string(re_match.group(0))
                 file_change_requests.append(file_change_request)
                 if file_change_request.change_type in ("modify", "create"):
-                    new_file_change_request = copy.deepcopy(file_change_request)
-                    new_file_change_request.change_type = "check"
-                    new_file_change_request.instructions = ""
-                    new_file_change_request.parent = file_change_request
+                    new_file_change_request = file_change_request.model_copy(
+                        update={
+                            "change_type": "check",
+                            "instructions": "",
+                            "parent": file_change_request,
+                        }
+                    )
                     file_change_requests.append(new_file_change_request)
 
             if file_change_requests:
@@ -589,10 +592,11 @@ class SweepBot(CodeGenBot, GithubBot):
         # possible we need to do more changes
         if leftover_comments and not DEBUG:
             file_contents = file_change.code
-            new_fcr = copy.deepcopy(file_change_request)
             joined_comments = "\n".join(leftover_comments)
-            new_fcr.instructions = (
-                f"Address all of the unfinished code changes here: \n{joined_comments}"
+            new_fcr = file_change_request.model_copy(
+                update={
+                    "instructions": f"Address all of the unfinished code changes here: \n{joined_comments}"
+                }
             )
             (
                 file_content_changes,
@@ -1,15 +1,21 @@
 import json
 import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 from typing import Generator
 
 import backoff
 import numpy as np
 import requests
 from loguru import logger
-from redis import Redis
+from openai import APITimeoutError, RateLimitError
+from redis import BlockingConnectionPool, Redis
 from tqdm import tqdm
 import voyageai
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from voyageai import error as voyageai_error
 
@@ -21,26 +27,64 @@ from sweepai.utils.utils import Tiktoken
 # Now uses Voyage AI if available, with asymmetric embedding
 # CACHE_VERSION = "v2.0.04" + "-voyage" if VOYAGE_API_KEY else ""
 suffix = "-voyage-aws" if VOYAGE_API_USE_AWS else "-voyage" if VOYAGE_API_KEY else ""
-CACHE_VERSION = "v2.0.05" + suffix 
-redis_client: Redis = Redis.from_url(REDIS_URL)  # TODO: add lazy loading
+# v2.0.06: embeddings are cached as raw float16 bytes instead of JSON lists
+CACHE_VERSION = "v2.0.06" + suffix
+# keepalive + health checks keep pooled connections usable between embedding bursts.
+# The pool is shared by every ticket thread, so callers wait for a free connection
+# instead of failing (which would turn every cache hit into a paid re-embed).
+redis_client: Redis = Redis(
+    connection_pool=BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=64,
+        timeout=20,
+        socket_keepalive=True,
+        health_check_interval=30,
+    )
+)  # TODO: add lazy loading
 tiktoken_client = Tiktoken()
+# Voyage rejects requests over 120k tokens; leave headroom since we count with tiktoken
+VOYAGE_MAX_TOKENS_PER_BATCH = 100_000
 
 
-def cosine_similarity(a, B):
-    dot_product = np.dot(B, a.T)  # B is MxN, a.T is Nx1, resulting in Mx1
-    norm_a = np.linalg.norm(a)
-    norm_B = np.linalg.norm(B, axis=1)
-    return dot_product.flatten() / (norm_a * norm_B)  # Flatten to make it a 1D array
+@lru_cache(maxsize=1)
+def get_sagemaker_runtime():
+    # clients are thread-safe, so one client and its connection pool serve every batch
+    return boto3.client(
+        "sagemaker-runtime",
+        aws_access_key_id=VOYAGE_API_AWS_ACCESS_KEY,
+        aws_secret_access_key=VOYAGE_API_AWS_SECRET_KEY,
+        region_name=VOYAGE_API_AWS_REGION,
+        config=Config(max_pool_connections=32, retries={"mode": "adaptive"}),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_voyage_client():
+    return voyageai.Client()
+
+
+@lru_cache(maxsize=1)
+def get_openai_embeddings_client():
+    # the OpenAI client keeps an httpx connection pool, so reuse it across batches
+    return get_embeddings_client()
+
+
+# pooled connections must not be shared with forked worker processes
+os.register_at_fork(after_in_child=get_sagemaker_runtime.cache_clear)
+os.register_at_fork(after_in_child=get_voyage_client.cache_clear)
+os.register_at_fork(after_in_child=get_openai_embeddings_client.cache_clear)
+
+
+def dot_similarity(a, B):
+    # cosine similarity for unit-norm a and B: B is MxN, a is N, resulting in M (single gemv)
+    return B @ a.ravel()
 
 
 def chunk(texts: list[str], batch_size: int) -> Generator[list[str], None, None]:
-    logger.info(f"Truncating {len(texts)} texts")
-    texts = [text[:25000] if len(text) > 25000 else text for text in texts]
-    # remove empty string
-    texts = [text if text else " " for text in texts]
-    logger.info(f"Finished truncating {len(texts)} texts")
+    # truncate and replace empty strings in a single pass
+    texts = [text[:25000] if text else " " for text in texts]
     for i in range(0, len(texts), batch_size):
-        yield texts[i : i + batch_size] if i + batch_size < len(texts) else texts[i:]
+        yield texts[i : i + batch_size]
 
 
 # @file_cache(ignore_params=["texts"])
@@ -48,45 +92,55 @@ def get_query_texts_similarity(query: str, texts: str) -> list[float]:
     if not texts:
         return []
     embeddings = embed_text_array(texts)
-    embeddings = np.concatenate(embeddings)
-    query_embedding = np.array(openai_call_embedding([query], input_type="query")[0])
-    similarity = cosine_similarity(query_embedding, embeddings)
+    # document embeddings are normalized before they are cached, so only the query needs it
+    query_embedding = normalize_l2(openai_call_embedding([query], input_type="query")[0])
+    similarity = dot_similarity(query_embedding, embeddings)
     similarity = similarity.tolist()
     return similarity
 
 
 def normalize_l2(x):
-    x = np.array(x)
+    x = np.asarray(x)
+    # astype always copies, so the caller's array is never divided in place
+    x = x.astype(np.result_type(x, np.float32))
     if x.ndim == 1:
-        norm = np.linalg.norm(x)
+        norm = np.sqrt(np.dot(x, x))
         if norm == 0:
             return x
-        return x / norm
+        x /= norm
+        return x
     else:
-        norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
-        return np.where(norm == 0, x, x / norm)
+        # einsum fuses the square and the row sum, and the divide writes back into x
+        norm = np.sqrt(np.einsum("ij,ij->i", x, x))[:, None]
+        np.divide(x, norm, out=x, where=norm != 0)
+        return x
 
 
 # lru_cache(maxsize=20)
 # @redis_cache()
-def embed_text_array(texts: tuple[str]) -> list[np.ndarray]:
-    embeddings = []
+def embed_text_array(texts: tuple[str]) -> np.ndarray:
+    # returns a single contiguous (len(texts), dim) float32 array
     texts = [text if text else " " for text in texts]
     batches = [texts[i : i + BATCH_SIZE] for i in range(0, len(texts), BATCH_SIZE)]
-    workers = max(1, multiprocessing.cpu_count() // 4)
-    if workers > 1 and not VOYAGE_API_KEY:
-        with multiprocessing.Pool(
-            processes=workers
-        ) as pool:
-            embeddings = list(
-                tqdm(
-                    pool.imap(openai_with_expo_backoff, batches),
-                    total=len(batches),
-                    desc="openai embedding",
-                )
+    embeddings = np.empty((len(texts), 0), dtype=np.float32)
+    # embedding is network-bound (redis + https), so threads are enough and avoid forking
+    workers = min(32, 4 * multiprocessing.cpu_count(), len(batches))
+    with ThreadPoolExecutor(
+        max_workers=workers if workers > 1 and not VOYAGE_API_KEY else 1
+    ) as executor:
+        for i, batch_embeddings in enumerate(
+            tqdm(
+                executor.map(openai_with_expo_backoff, batches),
+                total=len(batches),
+                desc="openai embedding",
             )
-    else:
-        embeddings = [openai_with_expo_backoff(batch) for batch in tqdm(batches, desc="openai embedding")]
+        ):
+            if i == 0:  # the dimension is only known once the first batch returns
+                embeddings = np.empty(
+                    (len(texts), batch_embeddings.shape[1]), dtype=np.float32
+                )
+            start = i * BATCH_SIZE
+            embeddings[start : start + len(batch_embeddings)] = batch_embeddings
     return embeddings
 
 
@@ -95,12 +149,7 @@ def openai_call_embedding_router(batch: list[str], input_type: str="document"):
     if len(batch) == 0:
         return np.array([])
     if VOYAGE_API_USE_AWS:
-        sm_runtime = boto3.client(
-            "sagemaker-runtime",
-            aws_access_key_id=VOYAGE_API_AWS_ACCESS_KEY,
-            aws_secret_access_key=VOYAGE_API_AWS_SECRET_KEY,
-            region_name=VOYAGE_API_AWS_REGION
-        )
+        sm_runtime = get_sagemaker_runtime()
         input_json = json.dumps({
             "input": batch,
             "input_type": input_type, 
@@ -115,35 +164,77 @@ def openai_call_embedding_router(batch: list[str], input_type: str="document"):
         body = response["Body"]
         obj = json.load(body)
         data = obj["data"]
-        return np.array([vector["embedding"] for vector in data])
+        dim = len(data[0]["embedding"])
+        # stream the floats straight into one float32 buffer instead of a list of lists
+        embeddings = np.fromiter(
+            chain.from_iterable(vector["embedding"] for vector in data),
+            dtype=np.float32,
+            count=len(data) * dim,
+        ).reshape(len(data), dim)
+        return normalize_l2(embeddings)
     elif VOYAGE_API_KEY:
-        client = voyageai.Client()
+        client = get_voyage_client()
         result = client.embed(batch, model="voyage-code-2", input_type=input_type)
-        cut_dim = np.array([data for data in result.embeddings])
+        cut_dim = np.array(result.embeddings, dtype=np.float32)
         normalized_dim = normalize_l2(cut_dim)
         return normalized_dim
     else:
-        client = get_embeddings_client()
+        client = get_openai_embeddings_client()
+        # let the API shorten to 512 dims so the unused 1024 floats per vector are never sent
         response = client.embeddings.create(
-            input=batch, model="text-embedding-3-small", encoding_format="float"
+            input=batch,
+            model="text-embedding-3-small",
+            encoding_format="float",
+            dimensions=512,
+        )
+        cut_dim = np.array(
+            [data.embedding for data in response.data], dtype=np.float32
         )
-        cut_dim = np.array([data.embedding for data in response.data])[:, :512]
         normalized_dim = normalize_l2(cut_dim)
         # save results to redis
         return normalized_dim
 
+def pack_by_token_count(
+    batch: list[str], token_counts: list[int], max_tokens: int
+) -> list[list[str]]:
+    # greedily fills each group in order until the next text would exceed max_tokens
+    groups = [[]]
+    group_tokens = 0
+    for text, token_count in zip(batch, token_counts):
+        if groups[-1] and group_tokens + token_count > max_tokens:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(text)
+        group_tokens += token_count
+    return groups
+
+
 def openai_call_embedding(batch: list[str], input_type: str="document"):
+    # Voyage caps the tokens per request, so split oversized batches up front with one call per group
+    # instead of discovering the limit through repeated failed requests and halving.
+    if (VOYAGE_API_KEY or VOYAGE_API_USE_AWS) and len(batch) > 1:
+        groups = pack_by_token_count(
+            batch, tiktoken_client.count_batch(batch), VOYAGE_MAX_TOKENS_PER_BATCH
+        )
+        if len(groups) > 1:
+            return np.concatenate(
+                [embed_or_split_batch(group, input_type) for group in groups]
+            )
+    return embed_or_split_batch(batch, input_type)
+
+
+def embed_or_split_batch(batch: list[str], input_type: str="document"):
     # Backoff on batch size by splitting the batch in half.
-    # Better way is to download the tokenizer from https://huggingface.co/voyageai/voyage
-    # and check the token count manually, but it requires an extra dependency. 
+    # tiktoken only approximates Voyage's tokenizer (https://huggingface.co/voyageai/voyage),
+    # so a packed group can still go over the limit.
     try:
         return openai_call_embedding_router(batch, input_type)
     except (voyageai_error.InvalidRequestError, ClientError) as e: # full error is botocore.errorfactory.ModelError: but I can't find it
         if len(batch) > 1 and "Please lower the number of tokens in the batch." in str(e):
-            logger.error(f"Token count exceeded for batch: {max([tiktoken_client.count(text) for text in batch])} retrying by splitting batch in half.")
+            logger.error(f"Token count exceeded for batch: {max(tiktoken_client.count_batch(batch))} retrying by splitting batch in half.")
             mid = len(batch) // 2
-            left = openai_call_embedding(batch[:mid], input_type)
-            right = openai_call_embedding(batch[mid:], input_type)
+            left = embed_or_split_batch(batch[:mid], input_type)
+            right = embed_or_split_batch(batch[mid:], input_type)
             return np.concatenate((left, right))
         else:
             raise e
@@ -151,19 +242,25 @@ def openai_call_embedding(batch: list[str], input_type: str="document"):
 
 @backoff.on_exception(
     backoff.expo,
-    requests.exceptions.Timeout,
+    (requests.exceptions.Timeout, RateLimitError, APITimeoutError),
     max_tries=5,
 )
 def openai_with_expo_backoff(batch: tuple[str]):
     if not redis_client:
         return openai_call_embedding(batch)
+    # identical texts (license headers, boilerplate) are hashed, fetched and embedded once
+    text_to_index = {text: i for i, text in enumerate(dict.fromkeys(batch))}
+    unique_indices = [text_to_index[text] for text in batch]
+    batch = list(text_to_index)
     # check cache first
     embeddings = [None] * len(batch)
     cache_keys = [hash_sha256(text) + CACHE_VERSION for text in batch]
     try:
         for i, cache_value in enumerate(redis_client.mget(cache_keys)):
             if cache_value:
-                embeddings[i] = np.array(json.loads(cache_value))
+                embeddings[i] = np.frombuffer(cache_value, dtype=np.float16).astype(
+                    np.float32
+                )
     except Exception as e:
         logger.exception(e)
     # not stored in cache call openai
@@ -171,19 +268,21 @@ def openai_with_expo_backoff(batch: tuple[str]):
         text for i, text in enumerate(batch) if embeddings[i] is None
     ]  # remove all the cached values from the batch
     if len(batch) == 0:
-        embeddings = np.array(embeddings)
-        return embeddings  # all embeddings are in cache
+        return np.array(embeddings)[unique_indices]  # all embeddings are in cache
     try:
         # make sure all token counts are within model params (max: 8192)
 
         new_embeddings = openai_call_embedding(batch)
     except requests.exceptions.Timeout as e:
         logger.exception(f"Timeout error occured while embedding: {e}")
+    except (RateLimitError, APITimeoutError):
+        raise  # let backoff retry the whole batch
     except Exception as e:
         logger.exception(e)
-        if any(tiktoken_client.count(text) > 8192 for text in batch):
+        token_counts = tiktoken_client.count_batch(batch)
+        if any(token_count > 8192 for token_count in token_counts):
             logger.warning(
-                f"Token count exceeded for batch: {max([tiktoken_client.count(text) for text in batch])} truncating down to 8192 tokens."
+                f"Token count exceeded for batch: {max(token_counts)} truncating down to 8192 tokens."
             )
             batch = [tiktoken_client.truncate_string(text) for text in batch]
             new_embeddings = openai_call_embedding(batch)
@@ -195,20 +294,19 @@ def openai_with_expo_backoff(batch: tuple[str]):
     assert len(indices) == len(new_embeddings)
     for i, index in enumerate(indices):
         embeddings[index] = new_embeddings[i]
-    # store in cache
+    # store only the newly computed embeddings, cache hits are already in redis
     try:
         redis_client.mset(
             {
-                cache_key: json.dumps(embedding.tolist())
-                for cache_key, embedding in zip(cache_keys, embeddings)
+                cache_keys[index]: embeddings[index].astype(np.float16).tobytes()
+                for index in indices
             }
         )
-        embeddings = np.array(embeddings)
     except Exception:
         # logger.error(str(e))
         # logger.error("Failed to store embeddings in cache, returning without storing")
         pass
-    return embeddings
+    return np.array(embeddings)[unique_indices]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+from sweepai.core.vector_db import pack_by_token_count
+
+
+def test_pack_by_token_count_preserves_order():
+    batch = ["a", "b", "c", "d", "e"]
+    groups = pack_by_token_count(batch, [3, 3, 3, 3, 3], max_tokens=7)
+    assert groups == [["a", "b"], ["c", "d"], ["e"]]
+    assert [text for group in groups for text in group] == batch
+
+
+def test_pack_by_token_count_oversized_text_gets_own_group():
+    groups = pack_by_token_count(["a", "big", "b"], [1, 50, 1], max_tokens=10)
+    assert groups == [["a"], ["big"], ["b"]]
+
+
+def test_pack_by_token_count_fits_in_one_group():
+    assert pack_by_token_count(["a", "b"], [5, 5], max_tokens=10) == [["a", "b"]]
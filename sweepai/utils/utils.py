@@ -538,6 +538,15 @@ class Tiktoken:
     def count(self, text: str, model: str = "gpt-4") -> int:
         return len(self.openai_models[model].encode(text, disallowed_special=()))
 
+    def count_batch(self, texts: list[str], model: str = "gpt-4") -> list[int]:
+        # encode_batch tokenizes on tiktoken's own threads in a single call
+        return [
+            len(tokens)
+            for tokens in self.openai_models[model].encode_batch(
+                texts, disallowed_special=()
+            )
+        ]
+
     def truncate_string(
         self, text: str, model: str = "gpt-4", max_tokens: int = 8192
     ) -> str:
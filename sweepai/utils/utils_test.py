@@ -1,6 +1,6 @@
 import pytest
 
-from sweepai.utils.utils import check_syntax
+from sweepai.utils.utils import Tiktoken, check_syntax
 
 
 @pytest.mark.parametrize(
@@ -15,3 +15,11 @@ def test_check_syntax(file_path, code, expected_validity, expected_message):
     validity, message = check_syntax(file_path, code)
     assert validity == expected_validity
     assert message == expected_message
+
+
+def test_tiktoken_count_batch():
+    tiktoken_client = Tiktoken()
+    texts = ["", "hello world", "def f():\n    return 1\n", "<|endoftext|>"]
+    assert tiktoken_client.count_batch(texts) == [
+        tiktoken_client.count(text) for text in texts
+    ]